@@ -1,9 +1,15 @@
+import asyncio
+import atexit
+import functools
 import json
-import datetime
+import logging
+from array import array
 import os
-import re
-from difflib import SequenceMatcher
-from typing import Tuple
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import List, Tuple
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import CommandStart, Command
@@ -13,10 +19,11 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from dotenv import load_dotenv
+from rapidfuzz import fuzz, process
 from aiogram.filters import StateFilter
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
-from typing import Callable, Awaitable, Dict, Any, Union
+from typing import Callable, Awaitable, Dict, Any, Optional, Union
 from time import monotonic
 
 class AntiFloodMiddleware(BaseMiddleware):
@@ -24,13 +31,26 @@ class AntiFloodMiddleware(BaseMiddleware):
     Рейт-лимит на пользователя:
     - limit_msg: минимальный интервал между сообщениями пользователя (сек)
     - limit_cb:  минимальный интервал между нажатиями кнопок (сек)
+    - max_users: сколько последних пользователей помнить (самые давние вытесняются)
     Сообщения/клики, пришедшие раньше интервала, просто тихо игнорируются.
     """
-    def __init__(self, limit_msg: float = 0.8, limit_cb: float = 0.3):
+    def __init__(self, limit_msg: float = 0.8, limit_cb: float = 0.3, max_users: int = 10_000):
         self.limit_msg = limit_msg
         self.limit_cb = limit_cb
-        self._last_msg: Dict[int, float] = {}
-        self._last_cb: Dict[int, float] = {}
+        self.max_users = max_users
+        # uid -> [время последнего сообщения, время последнего клика]
+        self._last: "OrderedDict[int, List[float]]" = OrderedDict()
+
+    def _slot(self, uid: int) -> List[float]:
+        """Отметки пользователя; самый давний пользователь вытесняется при переполнении."""
+        slot = self._last.get(uid)
+        if slot is None:
+            slot = self._last[uid] = [0.0, 0.0]
+            if len(self._last) > self.max_users:
+                self._last.popitem(last=False)
+        else:
+            self._last.move_to_end(uid)
+        return slot
 
     async def __call__(
         self,
@@ -38,28 +58,22 @@ class AntiFloodMiddleware(BaseMiddleware):
         event: Union[Message, CallbackQuery],
         data: Dict[str, Any]
     ) -> Any:
-        now = monotonic()
+        if not event.from_user:
+            return await handler(event, data)
 
-        # Ограничение по входящим сообщениям
-        if isinstance(event, Message) and event.from_user:
-            uid = event.from_user.id
-            last = self._last_msg.get(uid, 0.0)
-            if (now - last) < self.limit_msg:
-                return  # тихо отбрасываем
-            self._last_msg[uid] = now
-
-        # Ограничение по нажатиям кнопок
-        if isinstance(event, CallbackQuery) and event.from_user:
-            uid = event.from_user.id
-            last = self._last_cb.get(uid, 0.0)
-            if (now - last) < self.limit_cb:
+        now = monotonic()
+        # 0 — входящее сообщение, 1 — нажатие кнопки
+        kind = 0 if isinstance(event, Message) else 1
+        slot = self._slot(event.from_user.id)
+        if (now - slot[kind]) < (self.limit_msg, self.limit_cb)[kind]:
+            if kind:
                 # Можно ответить "молча", чтобы Telegram убрал "часики"
                 try:
                     await event.answer()
                 except Exception:
                     pass
-                return
-            self._last_cb[uid] = now
+            return  # тихо отбрасываем
+        slot[kind] = now
 
         return await handler(event, data)
 
@@ -70,33 +84,173 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")          # кому отправлять заявки
 SUPPORT_CHAT_ID = int(os.getenv("SUPPORT_CHAT_ID", 0))  # группа поддержки
+# 0/false/no/off или пустое значение — не писать chat_logs.txt
+LOG_ENABLED = os.getenv("LOG_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off", "")
 
 if not BOT_TOKEN:
     raise SystemExit("❌ BOT_TOKEN не найден. Укажите токен в .env")
 
+try:
+    ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
+except ValueError:
+    raise SystemExit("❌ ADMIN_CHAT_ID должен быть числом (id чата)")
+
 # ====== Логирование ======
+# Служебные ошибки бота — в bot.log (с ротацией) и в консоль.
+# Настраиваем только свой логгер (root и логгеры aiogram не трогаем), а запись
+# в файл/консоль идёт в отдельном потоке QueueListener, не блокируя event loop
+_log_formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+_log_file_handler = RotatingFileHandler("bot.log", maxBytes=1_000_000, backupCount=3, encoding="utf-8")
+_log_stream_handler = logging.StreamHandler()
+for _handler in (_log_file_handler, _log_stream_handler):
+    _handler.setFormatter(_log_formatter)
+_log_records: SimpleQueue = SimpleQueue()
+_log_listener = QueueListener(_log_records, _log_file_handler, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger("bigolive_bot")
+log.setLevel(logging.INFO)
+log.propagate = False
+log.addHandler(QueueHandler(_log_records))
+
 LOG_FILE = "chat_logs.txt"
+LOG_FLUSH_INTERVAL = 1.0  # сек
+
+# Файл открыт на всё время работы; запись буферизуется и сбрасывается раз в LOG_FLUSH_INTERVAL
+_LOG_FH = open(LOG_FILE, "a", encoding="utf-8", buffering=64 * 1024)
+atexit.register(_LOG_FH.close)
+
+LOG_BATCH_SIZE = 256
+LOG_QUEUE_SIZE = 10_000
+# Очередь строк лога; создаётся в main(), до этого пишем в файл напрямую.
+# При переполнении (например, диск не принимает запись) новые строки отбрасываются
+_log_queue: Optional[asyncio.Queue] = None
+_log_dropped = 0
+
+# Отформатированная метка времени кэшируется на текущую секунду
+_last_ts_int = 0
+_last_ts_str = ""
+
+def _log_timestamp() -> str:
+    global _last_ts_int, _last_ts_str
+    now_i = int(time.time())
+    if now_i != _last_ts_int:
+        _last_ts_int = now_i
+        _last_ts_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now_i))
+    return _last_ts_str
 
 def log_message(user_id, username, role, text):
-    """Записывает строку в файл лога."""
-    time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    """Ставит строку лога в очередь (запись на диск — в фоновой задаче)."""
+    global _log_dropped
+    if not LOG_ENABLED:
+        return
+    ts = _log_timestamp()
     uname = f"@{username}" if username else ""
-    clean_text = text.replace("\n", "\\n") if text else "<не текст>"
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{time}] ({user_id}) {uname} [{role}]: {clean_text}\n")
+    if not text:
+        clean_text = "<не текст>"
+    elif "\n" in text:
+        clean_text = text.replace("\n", "\\n")
+    else:
+        clean_text = text
+    line = f"[{ts}] ({user_id}) {uname} [{role}]: {clean_text}\n"
+    if _log_queue is None:
+        _LOG_FH.write(line)
+    else:
+        try:
+            _log_queue.put_nowait(line)
+        except asyncio.QueueFull:
+            _log_dropped += 1
+            if _log_dropped % 1000 == 1:
+                log.warning("Очередь лога переполнена, отброшено строк: %d", _log_dropped)
+
+async def log_writer(queue: asyncio.Queue):
+    """Забирает строки из очереди пачками и пишет их в файл одним write()."""
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty() and len(batch) < LOG_BATCH_SIZE:
+            batch.append(queue.get_nowait())
+        try:
+            _LOG_FH.write("".join(batch))
+        except Exception:
+            # Пачку теряем, но продолжаем разбирать очередь, чтобы она не росла
+            log.exception("Не удалось записать %d строк в %s", len(batch), LOG_FILE)
+
+def drain_log_queue(queue: asyncio.Queue):
+    """Дописывает в файл всё, что осталось в очереди (при остановке)."""
+    batch = []
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    _LOG_FH.write("".join(batch))
+    _LOG_FH.flush()
+
+async def flush_logs_periodically():
+    """Периодически сбрасывает буфер лога на диск."""
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            _LOG_FH.flush()
+        except Exception:
+            log.exception("Не удалось сбросить буфер %s", LOG_FILE)
+
+FORWARD_QUEUE_SIZE = 500
+FORWARD_CONCURRENCY = 4
+FORWARD_DRAIN_TIMEOUT = 5.0  # сек, сколько ждать недопересланное при остановке
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks = set()
+# Очередь пересылок в поддержку; создаётся в main(). При переполнении новые сообщения отбрасываются
+_forward_queue: Optional[asyncio.Queue] = None
+_forward_dropped = 0
+
+async def forward_to_support(message: Message, bot: Bot):
+    """Пересылает сообщение в группу поддержки."""
+    try:
+        await bot.forward_message(
+            chat_id=SUPPORT_CHAT_ID,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id
+        )
+    except Exception:
+        if log.isEnabledFor(logging.ERROR):
+            log.exception("Не удалось отправить в группу поддержки")
+
+async def forward_worker(queue: asyncio.Queue, bot: Bot):
+    """Разбирает очередь пересылок, держа не больше FORWARD_CONCURRENCY запросов к Telegram."""
+    sem = asyncio.Semaphore(FORWARD_CONCURRENCY)
+    while True:
+        # Семафор берём до get(): всё, что ещё не начато, остаётся в очереди
+        await sem.acquire()
+        message = await queue.get()
+        task = asyncio.create_task(forward_to_support(message, bot))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        task.add_done_callback(lambda _: (sem.release(), queue.task_done()))
+
+async def drain_forward_queue(queue: asyncio.Queue):
+    """Даёт пересылкам из очереди до FORWARD_DRAIN_TIMEOUT секунд и сообщает о потерянных."""
+    try:
+        await asyncio.wait_for(queue.join(), FORWARD_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning(
+            "Остановка: не переслано в поддержку %d сообщений из очереди и %d в процессе",
+            queue.qsize(), len(_background_tasks),
+        )
+    if _forward_dropped:
+        log.warning("Остановка: всего отброшено при переполнении очереди пересылки: %d", _forward_dropped)
 
 async def log_and_forward_incoming(message: Message, bot: Bot):
     """Логируем входящее и пересылаем в группу поддержки (если задана)."""
+    global _forward_dropped
     log_message(message.from_user.id, message.from_user.username, "USER", message.text or "<не текст>")
-    if SUPPORT_CHAT_ID:
+    if SUPPORT_CHAT_ID and _forward_queue is not None:
+        # Пересылка идёт в фоне — хендлер не ждёт ответа Telegram
         try:
-            await bot.forward_message(
-                chat_id=SUPPORT_CHAT_ID,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-        except Exception as e:
-            print("Не удалось отправить в группу поддержки:", e)
+            _forward_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            _forward_dropped += 1
+            if _forward_dropped % 100 == 1:
+                log.warning("Очередь пересылки переполнена, отброшено сообщений: %d", _forward_dropped)
 
 async def send_and_log(message: Message, text: str, **kwargs):
     """Отправляет сообщение и логирует как ответ бота."""
@@ -124,26 +278,83 @@ def build_main_kb():
     kb.adjust(1)
     return kb.as_markup()
 
+def build_faq_kb():
+    kb = InlineKeyboardBuilder()
+    for idx, cat in enumerate(CATEGORIES):
+        kb.button(text=cat.get("title", f"Категория {idx+1}"), callback_data=f"cat:{idx}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+def build_category_kb(idx: int, cat: dict):
+    kb = InlineKeyboardBuilder()
+    for i, item in enumerate(cat.get("items", [])):
+        first_pattern = item.get("patterns", ["Вопрос"])[0]
+        kb.button(text=first_pattern.capitalize(), callback_data=f"item:{idx}:{i}")
+    kb.button(text="← Назад", callback_data="faq")
+    kb.adjust(1)
+    return kb.as_markup()
+
+# Клавиатуры статичны — собираем один раз
+_MAIN_KB_MARKUP = build_main_kb()
+_FAQ_KB_MARKUP = build_faq_kb()
+_CAT_KBS = [build_category_kb(idx, cat) for idx, cat in enumerate(CATEGORIES)]
+
+_PUNCT_TABLE = str.maketrans("", "", ".,!?()-:;")
+
 def normalize(text: str) -> str:
-    text = text.lower().strip()
-    text = re.sub(r"[\s]+", " ", text)
-    text = re.sub(r"[.,!?()\-:;]", "", text)
-    return text
+    return " ".join(text.lower().translate(_PUNCT_TABLE).split())
+
+# Нормализованные паттерны считаем один раз при загрузке: (паттерн, item)
+_PATTERNS: List[Tuple[str, dict]] = [
+    (normalize(pattern), item)
+    for cat in CATEGORIES
+    for item in cat.get("items", [])
+    for pattern in item.get("patterns", [])
+]
+
+# Отдельный список строк для rapidfuzz; индекс совпадает с _PATTERNS
+_PATTERN_TEXTS: List[str] = [pattern for pattern, _ in _PATTERNS]
+
+# Инвертированный индекс: слово -> индексы паттернов, где оно встречается
+_INV: Dict[str, array] = {}
+for _idx, _pattern in enumerate(_PATTERN_TEXTS):
+    for _token in set(_pattern.split()):
+        _INV.setdefault(_token, array("i")).append(_idx)
+
+# Точные совпадения: нормализованный паттерн -> индекс
+_EXACT: Dict[str, int] = {}
+for _idx, _pattern in enumerate(_PATTERN_TEXTS):
+    _EXACT.setdefault(_pattern, _idx)
+
+@functools.lru_cache(maxsize=1024)
+def _best_faq_answer_cached(q: str, threshold: float) -> Tuple[int, float]:
+    """Ищет лучший паттерн для уже нормализованного запроса: (индекс в _PATTERNS или -1, score).
+    Кэш рассчитан на статичный faq.json — при перезагрузке FAQ нужен cache_clear()."""
+    exact = _EXACT.get(q)
+    if exact is not None:
+        return exact, 1.0
+    cutoff = threshold * 100
+    # Сначала сравниваем только с паттернами, у которых есть общее слово с запросом;
+    # если среди них ничего не прошло порог — полный проход (опечатки и т.п.)
+    candidates = set().union(*(_INV.get(t, ()) for t in q.split()))
+    match = None
+    if candidates:
+        match = process.extractOne(
+            q, {i: _PATTERN_TEXTS[i] for i in candidates}, scorer=fuzz.ratio, score_cutoff=cutoff
+        )
+    if match is None:
+        # score_cutoff позволяет rapidfuzz самому отсекать заведомо слабые паттерны
+        match = process.extractOne(q, _PATTERN_TEXTS, scorer=fuzz.ratio, score_cutoff=cutoff)
+    if match is None:
+        return -1, 0.0
+    _, score, idx = match
+    return idx, score / 100
 
 def best_faq_answer(user_text: str, threshold: float = 0.63) -> Tuple[dict, float]:
-    q = normalize(user_text)
-    best_score = 0.0
-    best_item = {}
-    for cat in CATEGORIES:
-        for item in cat.get("items", []):
-            for pattern in item.get("patterns", []):
-                score = SequenceMatcher(None, q, normalize(pattern)).ratio()
-                if score > best_score:
-                    best_score = score
-                    best_item = item
-    if best_score >= threshold:
-        return best_item, best_score
-    return {}, best_score
+    idx, score = _best_faq_answer_cached(normalize(user_text), threshold)
+    if idx < 0:
+        return {}, score
+    return _PATTERNS[idx][1], score
 
 
 # ====== FSM ======
@@ -164,7 +375,7 @@ async def on_start(message: Message, bot: Bot):
         "Привет! Я помощник по стримингу Bigo Live. Помогу подать заявку и отвечу на вопросы.\n\n"
         "Выберите действие ниже или напишите вопрос."
     )
-    await send_and_log(message, text, reply_markup=build_main_kb())
+    await send_and_log(message, text, reply_markup=_MAIN_KB_MARKUP)
 
 @router.message(Command("help"))
 async def on_help(message: Message, bot: Bot):
@@ -174,17 +385,14 @@ async def on_help(message: Message, bot: Bot):
 @router.message(Command("faq"))
 async def on_faq(message: Message, bot: Bot):
     await log_and_forward_incoming(message, bot)
-    kb = InlineKeyboardBuilder()
-    for idx, cat in enumerate(CATEGORIES):
-        kb.button(text=cat.get("title", f"Категория {idx+1}"), callback_data=f"cat:{idx}")
-    kb.adjust(1)
-    await send_and_log(message, "Выберите категорию:", reply_markup=kb.as_markup())
+    await send_and_log(message, "Выберите категорию:", reply_markup=_FAQ_KB_MARKUP)
 
 from aiogram import Bot  # если не импортирован выше
 
 @router.callback_query(F.data == "faq")
 async def cb_faq(callback: CallbackQuery, bot: Bot):
-    await on_faq(callback.message, bot)
+    # callback.message — сообщение бота: не логируем его как USER и не пересылаем в поддержку
+    await send_and_log(callback.message, "Выберите категорию:", reply_markup=_FAQ_KB_MARKUP)
     await callback.answer()
 
 
@@ -192,15 +400,9 @@ async def cb_faq(callback: CallbackQuery, bot: Bot):
 async def cb_category(callback: CallbackQuery):
     idx = int(callback.data.split(":")[1])
     cat = CATEGORIES[idx]
-    kb = InlineKeyboardBuilder()
-    for i, item in enumerate(cat.get("items", [])):
-        first_pattern = item.get("patterns", ["Вопрос"])[0]
-        kb.button(text=first_pattern.capitalize(), callback_data=f"item:{idx}:{i}")
-    kb.button(text="← Назад", callback_data="faq")
-    kb.adjust(1)
     # здесь callback.message — это сообщение бота; логировать исходящее:
     await send_and_log(callback.message, f"Категория: {cat.get('title')}")
-    await callback.message.edit_text(f"Категория: {cat.get('title')}", reply_markup=kb.as_markup())
+    await callback.message.edit_text(f"Категория: {cat.get('title')}", reply_markup=_CAT_KBS[idx])
     await callback.answer()
 
 @router.callback_query(F.data.startswith("item:"))
@@ -208,7 +410,7 @@ async def cb_item(callback: CallbackQuery):
     _, cidx, iidx = callback.data.split(":")
     cidx, iidx = int(cidx), int(iidx)
     item = CATEGORIES[cidx]["items"][iidx]
-    await send_and_log(callback.message, item.get("answer", ""), reply_markup=build_main_kb())
+    await send_and_log(callback.message, item.get("answer", ""), reply_markup=_MAIN_KB_MARKUP)
     await callback.answer()
 
 # ====== Анкета ======
@@ -258,7 +460,7 @@ async def apply_done(message: Message, state: FSMContext, bot: Bot):
     await state.update_data(experience=message.text.strip())
     data = await state.get_data()
     await state.clear()
-    await send_and_log(message, "Спасибо! Заявка отправлена менеджеру. Мы свяжемся в ближайшее время.", reply_markup=build_main_kb())
+    await send_and_log(message, "Спасибо! Заявка отправлена менеджеру. Мы свяжемся в ближайшее время.", reply_markup=_MAIN_KB_MARKUP)
     summary = (
         "📝 Новая заявка на стримера\n"
         f"Имя: {data.get('name')}\n"
@@ -266,13 +468,14 @@ async def apply_done(message: Message, state: FSMContext, bot: Bot):
         f"Контакт: {data.get('contact')}\n"
         f"Опыт: {data.get('experience')}"
     )
-    if ADMIN_CHAT_ID:
+    if ADMIN_CHAT_ID_INT is not None:
         try:
-            await bot.send_message(chat_id=int(ADMIN_CHAT_ID), text=summary)
-        except Exception as e:
-            print("Не удалось отправить менеджеру:", e)
+            await bot.send_message(chat_id=ADMIN_CHAT_ID_INT, text=summary)
+        except Exception:
+            if log.isEnabledFor(logging.ERROR):
+                log.exception("Не удалось отправить менеджеру")
     else:
-        print("ADMIN_CHAT_ID не задан. Заявка:\n" + summary)
+        log.warning("ADMIN_CHAT_ID не задан. Заявка:\n%s", summary)
 
 # ====== Контакт менеджера ======
 @router.message(Command("contact"))
@@ -284,7 +487,7 @@ async def contact(event, bot: Bot):
         "Для прохождения кастинга или если остался вопрос — напишите менеджеру.\n"
         "Ватсап: +79183253080."
     )
-    await send_and_log(message, text, reply_markup=build_main_kb())
+    await send_and_log(message, text, reply_markup=_MAIN_KB_MARKUP)
     if not isinstance(event, Message):
         await event.answer()
 
@@ -302,16 +505,16 @@ async def on_free_text(message: Message, bot: Bot):
                 chat_id=message.chat.id,
                 photo=image,
                 caption=answer,
-                reply_markup=build_main_kb()
+                reply_markup=_MAIN_KB_MARKUP
             )
             log_message(message.from_user.id, message.from_user.username, "BOT", f"[PHOTO] {answer}")
         else:
-            await send_and_log(message, answer, reply_markup=build_main_kb())
+            await send_and_log(message, answer, reply_markup=_MAIN_KB_MARKUP)
     else:
         await send_and_log(
             message,
             "Пока не нашёл точный ответ. Выберите, что вам нужно:",
-            reply_markup=build_main_kb()
+            reply_markup=_MAIN_KB_MARKUP
         )
 
 
@@ -327,12 +530,29 @@ async def main():
 
     dp.include_router(router)
     bot = Bot(BOT_TOKEN)
+
+    global _log_queue, _forward_queue
+    _log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    _forward_queue = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE)
+    writer_task = asyncio.create_task(log_writer(_log_queue))
+    flush_task = asyncio.create_task(flush_logs_periodically())
+    forward_task = asyncio.create_task(forward_worker(_forward_queue, bot))
     print("🤖 Bot is running. Press Ctrl+C to stop.")
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        # Сессию бота закрываем сами — после того как дошлём очередь пересылок
+        await dp.start_polling(
+            bot, allowed_updates=dp.resolve_used_update_types(), close_bot_session=False
+        )
+    finally:
+        await drain_forward_queue(_forward_queue)
+        forward_task.cancel()
+        await bot.session.close()
+        writer_task.cancel()
+        flush_task.cancel()
+        drain_log_queue(_log_queue)
 
 
 if __name__ == "__main__":
-    import asyncio
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):